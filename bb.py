@@ -5,6 +5,7 @@ bb - A function pool manager for Python code
 import ast
 import argparse
 import builtins
+import functools
 import hashlib
 import itertools
 import json
@@ -52,6 +53,142 @@ _ENCODE_FALSE = 0x09
 _ENCODE_UUID = 0x0A
 _ENCODE_BBH = 0x0B
 
+# Precompiled big-endian packers, so the format string is parsed once
+_STRUCT_UINT64 = struct.Struct('>Q')
+_STRUCT_DOUBLE = struct.Struct('>d')
+
+# XOR masks applied to the IEEE 754 bits of floats so that byte order matches
+# numeric order: positives get their sign bit set, negatives are inverted
+_FLOAT_FLIP_POSITIVE = 0x8000000000000000
+_FLOAT_FLIP_NEGATIVE = 0xFFFFFFFFFFFFFFFF
+
+
+# Encoders append the encoding of value to out; nested is True for items
+# inside a nested tuple
+
+def bytes_write_none(value: None, out: bytearray, nested: bool) -> None:
+    """Encode None; inside a nested tuple it is escaped so it cannot end the tuple."""
+    out.append(_ENCODE_NULL)
+    if nested:
+        out.append(0xFF)
+
+
+def bytes_write_bool(value: bool, out: bytearray, nested: bool) -> None:
+    """Encode a boolean."""
+    out.append(_ENCODE_TRUE if value else _ENCODE_FALSE)
+
+
+def bytes_write_bytes(value: bytes, out: bytearray, nested: bool) -> None:
+    """Encode bytes, escaping 0x00 as 0x00 0xFF."""
+    out.append(_ENCODE_BYTES)
+    out += value.replace(b'\x00', b'\x00\xFF')
+    out.append(0x00)
+
+
+def bytes_write_str(value: str, out: bytearray, nested: bool) -> None:
+    """Encode a string as escaped UTF-8."""
+    out.append(_ENCODE_STRING)
+    out += value.encode('utf-8').replace(b'\x00', b'\x00\xFF')
+    out.append(0x00)
+
+
+def bytes_write_int(value: int, out: bytearray, nested: bool) -> None:
+    """Encode an integer as its sign code followed by 8 big-endian bytes."""
+    if value == 0:
+        out.append(_ENCODE_INT_ZERO)
+    elif value > 0:
+        out.append(_ENCODE_INT_POS)
+        out += _STRUCT_UINT64.pack(value)
+    else:
+        out.append(_ENCODE_INT_NEG)
+        out += _STRUCT_UINT64.pack((1 << 64) - 1 + value)
+
+
+def bytes_write_float(value: float, out: bytearray, nested: bool) -> None:
+    """Encode a float so that byte order matches numeric order."""
+    if value == 0:
+        # Zero floats share the integer zero code, like they always have
+        out.append(_ENCODE_INT_ZERO)
+        return
+    bits = _STRUCT_UINT64.unpack(_STRUCT_DOUBLE.pack(value))[0]
+    # Flip sign bit, or flip all bits if negative, as one 64-bit XOR
+    bits ^= _FLOAT_FLIP_NEGATIVE if bits >> 63 else _FLOAT_FLIP_POSITIVE
+    out.append(_ENCODE_FLOAT)
+    out += _STRUCT_UINT64.pack(bits)
+
+
+def bytes_write_uuid(value: uuid.UUID, out: bytearray, nested: bool) -> None:
+    """Encode a UUID."""
+    # UUIDs are stored as 16 bytes (128 bits)
+    # UUID.bytes maintains lexicographic ordering for ULIDs
+    out.append(_ENCODE_UUID)
+    out += value.bytes
+
+
+def bytes_write_bbh(value: BBH, out: bytearray, nested: bool) -> None:
+    """Encode a BBH hash."""
+    # BBH stores a SHA256 hash (32 bytes)
+    # value can be bytes or hex string
+    if isinstance(value.value, bytes):
+        if len(value.value) != 32:
+            raise ValueError(f"BBH bytes must be exactly 32 bytes, got {len(value.value)}")
+        out.append(_ENCODE_BBH)
+        out += value.value
+    elif isinstance(value.value, str):
+        if len(value.value) != 64:
+            raise ValueError(f"BBH hex string must be exactly 64 characters, got {len(value.value)}")
+        out.append(_ENCODE_BBH)
+        out += bytes.fromhex(value.value)
+    else:
+        raise ValueError(f"BBH value must be bytes or hex string, got {type(value.value)}")
+
+
+def bytes_write_nested(value: Union[tuple, list], out: bytearray, nested: bool) -> None:
+    """Encode a tuple or list as a nested tuple, in place in out."""
+    out.append(_ENCODE_NESTED)
+    for item in value:
+        bytes_write_into(item, out, True)
+    out.append(0x00)
+
+
+# Encoders keyed by exact type, so bytes_write_into costs one dict lookup
+# instead of a chain of isinstance checks
+_BYTES_WRITERS = {
+    type(None): bytes_write_none,
+    bool: bytes_write_bool,
+    bytes: bytes_write_bytes,
+    str: bytes_write_str,
+    int: bytes_write_int,
+    float: bytes_write_float,
+    uuid.UUID: bytes_write_uuid,
+    BBH: bytes_write_bbh,
+    tuple: bytes_write_nested,
+    list: bytes_write_nested,
+}
+
+
+def bytes_write_into(value: Any, out: bytearray, nested: bool = False) -> None:
+    """Append the order-preserving encoding of a single value to a buffer.
+
+    Args:
+        value: Value to encode
+        out: Buffer the encoding is appended to
+        nested: Whether this is nested inside a tuple
+    """
+    writer = _BYTES_WRITERS.get(type(value))
+    if writer is None:
+        # Subclasses (IntEnum, namedtuples, ...) use their nearest supported base
+        for base in type(value).__mro__:
+            writer = _BYTES_WRITERS.get(base)
+            if writer is not None:
+                break
+        else:
+            if value == 0:
+                out.append(_ENCODE_INT_ZERO)
+                return
+            raise ValueError(f"Unsupported type for encoding: {type(value)}")
+    writer(value, out, nested)
+
 
 def bytes_write_one(value: Any, nested: bool = False) -> bytes:
     """Encode a single value to bytes with order preservation.
@@ -63,50 +200,147 @@ def bytes_write_one(value: Any, nested: bool = False) -> bytes:
     Returns:
         Encoded bytes
     """
-    if value is None:
-        return bytes([_ENCODE_NULL, 0xFF] if nested else [_ENCODE_NULL])
-    elif isinstance(value, bool):
-        return bytes([_ENCODE_TRUE if value else _ENCODE_FALSE])
-    elif isinstance(value, bytes):
-        return bytes([_ENCODE_BYTES]) + value.replace(b'\x00', b'\x00\xFF') + b'\x00'
-    elif isinstance(value, str):
-        return bytes([_ENCODE_STRING]) + value.encode('utf-8').replace(b'\x00', b'\x00\xFF') + b'\x00'
-    elif value == 0:
-        return bytes([_ENCODE_INT_ZERO])
-    elif isinstance(value, int):
-        if value > 0:
-            return bytes([_ENCODE_INT_POS]) + struct.pack('>Q', value)
-        else:
-            return bytes([_ENCODE_INT_NEG]) + struct.pack('>Q', (1 << 64) - 1 + value)
-    elif isinstance(value, float):
-        bits = struct.pack('>d', value)
-        # Flip sign bit, or flip all bits if negative
-        if bits[0] & 0x80:
-            bits = bytes(b ^ 0xFF for b in bits)
-        else:
-            bits = bytes([bits[0] ^ 0x80]) + bits[1:]
-        return bytes([_ENCODE_FLOAT]) + bits
-    elif isinstance(value, uuid.UUID):
-        # UUIDs are stored as 16 bytes (128 bits)
-        # UUID.bytes maintains lexicographic ordering for ULIDs
-        return bytes([_ENCODE_UUID]) + value.bytes
-    elif isinstance(value, BBH):
-        # BBH stores a SHA256 hash (32 bytes)
-        # value can be bytes or hex string
-        if isinstance(value.value, bytes):
-            if len(value.value) != 32:
-                raise ValueError(f"BBH bytes must be exactly 32 bytes, got {len(value.value)}")
-            return bytes([_ENCODE_BBH]) + value.value
-        elif isinstance(value.value, str):
-            if len(value.value) != 64:
-                raise ValueError(f"BBH hex string must be exactly 64 characters, got {len(value.value)}")
-            return bytes([_ENCODE_BBH]) + bytes.fromhex(value.value)
+    out = bytearray()
+    bytes_write_into(value, out, nested)
+    return bytes(out)
+
+
+def bytes_find_terminator(data: bytes, pos: int) -> int:
+    """Find the 0x00 that ends an escaped bytes or string payload.
+
+    Args:
+        data: Encoded bytes
+        pos: Position of the first payload byte
+
+    Returns:
+        Position of the terminating 0x00, or len(data) if there is none
+
+    Jumps between 0x00 bytes with bytes.find, which scans in C, and skips
+    the escaped 0x00 0xFF pairs instead of stepping through every byte.
+    """
+    end = data.find(b'\x00', pos)
+    while end != -1 and data[end + 1:end + 2] == b'\xFF':
+        end = data.find(b'\x00', end + 2)
+    return len(data) if end == -1 else end
+
+
+# Decoders take the encoded bytes and the position of the type code, and
+# return (decoded_value, next_position)
+
+def bytes_read_none(data: bytes, pos: int) -> Tuple[None, int]:
+    """Decode None."""
+    return (None, pos + 1)
+
+
+def bytes_read_bytes(data: bytes, pos: int) -> Tuple[bytes, int]:
+    """Decode escaped bytes."""
+    end = bytes_find_terminator(data, pos + 1)
+    return (data[pos + 1:end].replace(b'\x00\xFF', b'\x00'), end + 1)
+
+
+def bytes_read_str(data: bytes, pos: int) -> Tuple[str, int]:
+    """Decode an escaped UTF-8 string."""
+    end = bytes_find_terminator(data, pos + 1)
+    return (data[pos + 1:end].replace(b'\x00\xFF', b'\x00').decode('utf-8'), end + 1)
+
+
+def bytes_read_nested(data: bytes, pos: int) -> Tuple[tuple, int]:
+    """Decode a nested tuple, and any tuples nested in it, without recursion."""
+    # One list per open tuple: NESTED pushes, an unescaped 0x00 pops
+    stack: List[list] = [[]]
+    pos += 1
+    size = len(data)
+    while pos < size:
+        code = data[pos]
+        if code == 0x00:
+            if pos + 1 < size and data[pos + 1] == 0xFF:
+                stack[-1].append(None)
+                pos += 2
+                continue
+            pos += 1
+            items = tuple(stack.pop())
+            if not stack:
+                return (items, pos)
+            stack[-1].append(items)
+        elif code == _ENCODE_NESTED:
+            stack.append([])
+            pos += 1
+        elif code < len(_BYTES_READERS):
+            val, pos = _BYTES_READERS[code](data, pos)
+            stack[-1].append(val)
         else:
-            raise ValueError(f"BBH value must be bytes or hex string, got {type(value.value)}")
-    elif isinstance(value, (tuple, list)):
-        return bytes([_ENCODE_NESTED]) + b''.join(bytes_write_one(v, True) for v in value) + bytes([0x00])
-    else:
-        raise ValueError(f"Unsupported type for encoding: {type(value)}")
+            raise ValueError(f"Unknown encode type code: {code}")
+    # Truncated input: close the tuples that are still open
+    while len(stack) > 1:
+        items = tuple(stack.pop())
+        stack[-1].append(items)
+    return (tuple(stack[0]), pos + 1)
+
+
+def bytes_read_int_zero(data: bytes, pos: int) -> Tuple[int, int]:
+    """Decode integer zero."""
+    return (0, pos + 1)
+
+
+def bytes_read_int_pos(data: bytes, pos: int) -> Tuple[int, int]:
+    """Decode a positive integer."""
+    return (_STRUCT_UINT64.unpack_from(data, pos + 1)[0], pos + 9)
+
+
+def bytes_read_int_neg(data: bytes, pos: int) -> Tuple[int, int]:
+    """Decode a negative integer."""
+    val = _STRUCT_UINT64.unpack_from(data, pos + 1)[0]
+    return (val - ((1 << 64) - 1), pos + 9)
+
+
+def bytes_read_float(data: bytes, pos: int) -> Tuple[float, int]:
+    """Decode a float."""
+    bits = _STRUCT_UINT64.unpack_from(data, pos + 1)[0]
+    # Encoded positives have the sign bit set, negatives have it cleared
+    bits ^= _FLOAT_FLIP_POSITIVE if bits >> 63 else _FLOAT_FLIP_NEGATIVE
+    return (_STRUCT_DOUBLE.unpack(_STRUCT_UINT64.pack(bits))[0], pos + 9)
+
+
+def bytes_read_true(data: bytes, pos: int) -> Tuple[bool, int]:
+    """Decode True."""
+    return (True, pos + 1)
+
+
+def bytes_read_false(data: bytes, pos: int) -> Tuple[bool, int]:
+    """Decode False."""
+    return (False, pos + 1)
+
+
+def bytes_read_uuid(data: bytes, pos: int) -> Tuple[uuid.UUID, int]:
+    """Decode a UUID."""
+    # UUIDs are stored as 16 bytes (128 bits)
+    return (uuid.UUID(bytes=data[pos + 1:pos + 17]), pos + 17)
+
+
+def bytes_read_bbh(data: bytes, pos: int) -> Tuple[BBH, int]:
+    """Decode a BBH hash."""
+    # BBH stores a SHA256 hash (32 bytes)
+    # Return as hex string for easier use
+    hash_bytes = data[pos + 1:pos + 33]
+    return (BBH(hash_bytes.hex()), pos + 33)
+
+
+# Decoders indexed by type code: the codes are 0x00..0x0B, so a list lookup
+# replaces the elif chain
+_BYTES_READERS = [
+    bytes_read_none,
+    bytes_read_bytes,
+    bytes_read_str,
+    bytes_read_nested,
+    bytes_read_int_zero,
+    bytes_read_int_pos,
+    bytes_read_int_neg,
+    bytes_read_float,
+    bytes_read_true,
+    bytes_read_false,
+    bytes_read_uuid,
+    bytes_read_bbh,
+]
 
 
 def bytes_read_one(data: bytes, pos: int = 0) -> Tuple[Any, int]:
@@ -120,64 +354,9 @@ def bytes_read_one(data: bytes, pos: int = 0) -> Tuple[Any, int]:
         Tuple of (decoded_value, next_position)
     """
     code = data[pos]
-    if code == _ENCODE_NULL:
-        return (None, pos + 1)
-    elif code == _ENCODE_BYTES:
-        end = pos + 1
-        while end < len(data):
-            if data[end] == 0x00 and (end + 1 >= len(data) or data[end + 1] != 0xFF):
-                break
-            end += 1 if data[end] != 0x00 else 2
-        return (data[pos + 1:end].replace(b'\x00\xFF', b'\x00'), end + 1)
-    elif code == _ENCODE_STRING:
-        end = pos + 1
-        while end < len(data):
-            if data[end] == 0x00 and (end + 1 >= len(data) or data[end + 1] != 0xFF):
-                break
-            end += 1 if data[end] != 0x00 else 2
-        return (data[pos + 1:end].replace(b'\x00\xFF', b'\x00').decode('utf-8'), end + 1)
-    elif code == _ENCODE_INT_ZERO:
-        return (0, pos + 1)
-    elif code == _ENCODE_INT_POS:
-        return (struct.unpack('>Q', data[pos + 1:pos + 9])[0], pos + 9)
-    elif code == _ENCODE_INT_NEG:
-        val = struct.unpack('>Q', data[pos + 1:pos + 9])[0]
-        return (val - ((1 << 64) - 1), pos + 9)
-    elif code == _ENCODE_FLOAT:
-        bits = bytearray(data[pos + 1:pos + 9])
-        if bits[0] & 0x80:
-            bits[0] ^= 0x80
-        else:
-            bits = bytes(b ^ 0xFF for b in bits)
-        return (struct.unpack('>d', bytes(bits))[0], pos + 9)
-    elif code == _ENCODE_TRUE:
-        return (True, pos + 1)
-    elif code == _ENCODE_FALSE:
-        return (False, pos + 1)
-    elif code == _ENCODE_UUID:
-        # UUIDs are stored as 16 bytes (128 bits)
-        return (uuid.UUID(bytes=data[pos + 1:pos + 17]), pos + 17)
-    elif code == _ENCODE_BBH:
-        # BBH stores a SHA256 hash (32 bytes)
-        # Return as hex string for easier use
-        hash_bytes = data[pos + 1:pos + 33]
-        return (BBH(hash_bytes.hex()), pos + 33)
-    elif code == _ENCODE_NESTED:
-        result = []
-        pos += 1
-        while pos < len(data):
-            if data[pos] == 0x00:
-                if pos + 1 < len(data) and data[pos + 1] == 0xFF:
-                    result.append(None)
-                    pos += 2
-                else:
-                    break
-            else:
-                val, pos = bytes_read_one(data, pos)
-                result.append(val)
-        return (tuple(result), pos + 1)
-    else:
+    if code >= len(_BYTES_READERS):
         raise ValueError(f"Unknown encode type code: {code}")
+    return _BYTES_READERS[code](data, pos)
 
 
 def bytes_write(items: Tuple) -> bytes:
@@ -189,22 +368,29 @@ def bytes_write(items: Tuple) -> bytes:
     Returns:
         Encoded bytes that preserve lexicographic order
     """
-    return b''.join(bytes_write_one(item) for item in items)
+    out = bytearray()
+    for item in items:
+        bytes_write_into(item, out)
+    return bytes(out)
 
 
-def bytes_read(data: bytes) -> Tuple:
+def bytes_read(data: bytes, pos: int = 0) -> Tuple:
     """Decode bytes back to tuple.
 
     Args:
         data: Encoded bytes
+        pos: Position to start decoding from, to skip a known encoded prefix
 
     Returns:
         Decoded tuple
     """
     result = []
-    pos = 0
-    while pos < len(data):
-        val, pos = bytes_read_one(data, pos)
+    size = len(data)
+    while pos < size:
+        code = data[pos]
+        if code >= len(_BYTES_READERS):
+            raise ValueError(f"Unknown encode type code: {code}")
+        val, pos = _BYTES_READERS[code](data, pos)
         result.append(val)
     return tuple(result)
 
@@ -232,14 +418,12 @@ def bytes_next(data: bytes) -> Optional[bytes]:
     if not data:
         return b'\x00'
 
-    # Find rightmost byte that's not 0xFF
-    for i in range(len(data) - 1, -1, -1):
-        if data[i] != 0xFF:
-            # Increment this byte and truncate everything after
-            return data[:i] + bytes([data[i] + 1])
-
-    # All bytes are 0xFF, no successor exists
-    return None
+    # Drop trailing 0xFF bytes in C, then increment the rightmost byte left
+    head = data.rstrip(b'\xFF')
+    if not head:
+        # All bytes are 0xFF, no successor exists
+        return None
+    return head[:-1] + bytes([head[-1] + 1])
 
 
 def ulid() -> uuid.UUID:
@@ -286,23 +470,149 @@ def ulid() -> uuid.UUID:
 
 ### SQLITE3 ORDERED KEY-VALUE STORE ###
 
-def db_open(path: str) -> sqlite3.Connection:
+# Range scan SQL is prebuilt for every (reverse, has_limit, has_offset) shape,
+# so range helpers do no string building and always hit the statement cache.
+# SQLite only accepts OFFSET after LIMIT, where LIMIT -1 means unbounded.
+_DB_RANGE_PAGINATION = {
+    (False, False): '',
+    (True, False): ' LIMIT ?',
+    (False, True): ' LIMIT -1 OFFSET ?',
+    (True, True): ' LIMIT ? OFFSET ?',
+}
+
+_DB_RANGE_ORDER = {False: ' ORDER BY key ASC', True: ' ORDER BY key DESC'}
+
+
+def db_range_sql(select: str, ordered: bool = True) -> Dict[Tuple[bool, bool, bool], str]:
+    """Build range scan SQL for every (reverse, has_limit, has_offset) shape.
+
+    Args:
+        select: Column list to select from the kv table
+        ordered: Whether rows must come in scan direction; when False both
+            directions share the same SQL, without ORDER BY
+
+    Returns:
+        Dictionary mapping (reverse, has_limit, has_offset) to SQL text
+    """
+    return {
+        (reverse, has_limit, has_offset): (
+            f'SELECT {select} FROM kv WHERE key >= ? AND key < ?'
+            + (order if ordered else '')
+            + pagination
+        )
+        for reverse, order in _DB_RANGE_ORDER.items()
+        for (has_limit, has_offset), pagination in _DB_RANGE_PAGINATION.items()
+    }
+
+
+def db_range_params(key: bytes, other: bytes, offset: int, limit: Optional[int]) -> Tuple[Tuple[bool, bool, bool], Tuple]:
+    """Compute the SQL shape and parameters of a range scan.
+
+    Args:
+        key: Start key (inclusive if forward, exclusive if reverse)
+        other: End key (exclusive if forward, inclusive if reverse)
+        offset: Number of results to skip
+        limit: Maximum results, or None
+
+    Returns:
+        Tuple of ((reverse, has_limit, has_offset), params) where params is
+        the tuple to bind to the SQL of that shape
+    """
+    if key <= other:
+        # Forward scan: key <= k < other
+        reverse, low, high = False, key, other
+    else:
+        # Reverse scan: other <= k < key, descending order
+        reverse, low, high = True, other, key
+    if limit is None:
+        if offset > 0:
+            return ((reverse, False, True), (low, high, offset))
+        return ((reverse, False, False), (low, high))
+    if offset > 0:
+        return ((reverse, True, True), (low, high, limit, offset))
+    return ((reverse, True, False), (low, high, limit))
+
+
+_DB_RANGE_SCAN = db_range_sql('key, value')
+
+# Paginated subqueries only carry what the outer aggregate needs: one integer
+# size per row instead of two BLOBs, and a constant for counting
+_DB_RANGE_BYTES = {
+    shape: f'SELECT COALESCE(SUM(size), 0) FROM ({query})'
+    for shape, query in db_range_sql('LENGTH(key) + LENGTH(value) AS size').items()
+}
+# Without LIMIT/OFFSET the sum does not depend on scan order: aggregate in a
+# single pass over the range instead of going through an ordered subquery
+_DB_RANGE_BYTES.update({
+    (reverse, False, False): 'SELECT COALESCE(SUM(LENGTH(key) + LENGTH(value)), 0) FROM kv WHERE key >= ? AND key < ?'
+    for reverse in (False, True)
+})
+
+# Skipping `offset` keys then keeping `limit` leaves the same number of keys
+# whichever end the scan starts from, so counting never needs ORDER BY
+_DB_RANGE_COUNT = {
+    shape: f'SELECT COUNT(*) FROM ({query})'
+    for shape, query in db_range_sql('1', ordered=False).items()
+}
+_DB_RANGE_COUNT.update({
+    (reverse, False, False): 'SELECT COUNT(*) FROM kv WHERE key >= ? AND key < ?'
+    for reverse in (False, True)
+})
+
+# Keys bound per IN (...) lookup in db_get_many, well under SQLite's limit
+# on host parameters per statement
+_DB_GET_MANY_CHUNK = 500
+
+
+def db_open(path: str, readonly: bool = False) -> sqlite3.Connection:
     """Open a SQLite3 ordered key-value store.
 
     Args:
         path: Path to database file
+        readonly: Open an existing database file in read-only mode
 
     Returns:
         SQLite connection
-    """
-    conn = sqlite3.Connection(path)
+
+    The connection is meant to be long-lived: WAL journaling is persistent in
+    the database file, and the per-connection PRAGMAs are applied once here
+    instead of on every operation.
+
+    Read-only connections are meant to sit next to a single writer: under WAL
+    they read the last committed snapshot without waiting on the writer, so
+    scans can run on as many connections as there are cores. They need an
+    existing database file, created by a writer with the kv table in WAL mode,
+    and never write to it, not even the journal mode or the schema.
+    ':memory:' databases are private to their connection and cannot be opened
+    read-only.
+    """
+    if readonly:
+        if path == ':memory:':
+            raise ValueError("Read-only connections need a database file, not ':memory:'")
+        conn = sqlite3.Connection(Path(path).resolve().as_uri() + '?mode=ro', uri=True)
+        # Refuse writes at the statement level too, db_close relies on it
+        conn.execute('PRAGMA query_only=ON')
+    else:
+        conn = sqlite3.Connection(path)
+        # WAL lets readers proceed while a writer commits; with WAL, synchronous=NORMAL
+        # only fsyncs at checkpoint time and remains safe against corruption
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+    # Read through a 256 MiB memory map, keep up to 64 MiB of pages cached,
+    # and build temporary b-trees in memory instead of on disk
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-65536')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    if readonly:
+        return conn
+    # WITHOUT ROWID clusters rows in the primary key b-tree: values live next
+    # to their keys and range scans never need a second index lookup
     conn.execute('''
         CREATE TABLE IF NOT EXISTS kv (
             key BLOB PRIMARY KEY,
             value BLOB NOT NULL
-        )
+        ) WITHOUT ROWID
     ''')
-    conn.execute('CREATE INDEX IF NOT EXISTS idx_key ON kv(key)')
     conn.commit()
     return conn
 
@@ -312,8 +622,22 @@ def db_close(conn: sqlite3.Connection) -> None:
 
     Args:
         conn: SQLite connection
+
+    Runs PRAGMA optimize first, as SQLite recommends before closing a
+    long-lived connection: it refreshes planner statistics only when the
+    queries run on this connection would benefit, and is a no-op otherwise.
+    Read-only connections cannot store statistics and skip it. Closing an
+    already closed connection is a no-op, and the connection is closed even
+    when the optimize step fails.
     """
-    conn.close()
+    try:
+        if not conn.execute('PRAGMA query_only').fetchone()[0]:
+            conn.execute('PRAGMA optimize')
+    except sqlite3.ProgrammingError:
+        # Already closed; any other misuse is raised again by close() below
+        pass
+    finally:
+        conn.close()
 
 
 def db_get(conn: sqlite3.Connection, key: bytes) -> Optional[bytes]:
@@ -331,6 +655,42 @@ def db_get(conn: sqlite3.Connection, key: bytes) -> Optional[bytes]:
     return row[0] if row else None
 
 
+def db_get_many(conn: sqlite3.Connection, keys: List[bytes]) -> List[Optional[bytes]]:
+    """Get values for several keys at once.
+
+    Args:
+        conn: SQLite connection
+        keys: Keys to lookup
+
+    Returns:
+        List of value bytes or None, in the same order as keys
+
+    Keys are looked up with one IN (...) statement per chunk of
+    _DB_GET_MANY_CHUNK keys, so SQLite walks the primary key b-tree once per
+    chunk instead of once per key.
+    """
+    found: Dict[bytes, bytes] = {}
+    for start in range(0, len(keys), _DB_GET_MANY_CHUNK):
+        chunk = keys[start:start + _DB_GET_MANY_CHUNK]
+        placeholders = ', '.join('?' * len(chunk))
+        cursor = conn.execute(f'SELECT key, value FROM kv WHERE key IN ({placeholders})', chunk)
+        found.update(cursor.fetchall())
+    return [found.get(key) for key in keys]
+
+
+def db_exists(conn: sqlite3.Connection, key: bytes) -> bool:
+    """Check whether a key is present, without reading its value.
+
+    Args:
+        conn: SQLite connection
+        key: Key to lookup
+
+    Returns:
+        True if the key exists
+    """
+    return conn.execute('SELECT 1 FROM kv WHERE key = ?', (key,)).fetchone() is not None
+
+
 def db_set(conn: sqlite3.Connection, key: bytes, value: bytes) -> None:
     """Set key-value pair.
 
@@ -344,7 +704,29 @@ def db_set(conn: sqlite3.Connection, key: bytes, value: bytes) -> None:
     """
     assert len(key) <= 1024, f"Key size {len(key)} exceeds maximum of 1024 bytes"
     assert len(value) <= 1048576, f"Value size {len(value)} exceeds maximum of 1048576 bytes"
-    conn.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, value))
+    conn.execute('INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value', (key, value))
+
+
+def db_set_many(conn: sqlite3.Connection, pairs: List[Tuple[bytes, bytes]]) -> None:
+    """Set several key-value pairs with a single prepared statement.
+
+    Args:
+        conn: SQLite connection
+        pairs: List of (key, value) pairs, same size limits as db_set
+
+    Raises:
+        AssertionError: If any key or value exceeds size limits
+
+    All pairs are validated before anything is written, then inserted with
+    executemany so SQLite compiles the statement once for the whole batch.
+    As with db_set, nothing is committed: wrap the call in db_transaction
+    to pay for a single commit.
+    """
+    pairs = list(pairs)
+    for key, value in pairs:
+        assert len(key) <= 1024, f"Key size {len(key)} exceeds maximum of 1024 bytes"
+        assert len(value) <= 1048576, f"Value size {len(value)} exceeds maximum of 1048576 bytes"
+    conn.executemany('INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value', pairs)
 
 
 def db_delete(conn: sqlite3.Connection, key: bytes) -> None:
@@ -357,6 +739,42 @@ def db_delete(conn: sqlite3.Connection, key: bytes) -> None:
     conn.execute('DELETE FROM kv WHERE key = ?', (key,))
 
 
+def db_delete_many(conn: sqlite3.Connection, keys: List[bytes]) -> int:
+    """Delete several keys with a single prepared statement.
+
+    Args:
+        conn: SQLite connection
+        keys: Keys to delete
+
+    Returns:
+        Number of key-value pairs actually deleted
+    """
+    cursor = conn.executemany('DELETE FROM kv WHERE key = ?', ((key,) for key in keys))
+    return cursor.rowcount
+
+
+def db_query_iter(conn: sqlite3.Connection, key: bytes, other: bytes, offset: int = 0, limit: Optional[int] = None) -> sqlite3.Cursor:
+    """Iterate over key-value pairs between key and other.
+
+    Same arguments, ordering and pagination as db_query, but rows are pulled
+    from SQLite one at a time as the caller iterates, so scanning a large
+    range keeps memory flat instead of materializing every pair up front.
+
+    Args:
+        conn: SQLite connection
+        key: Start key (inclusive if forward, exclusive if reverse)
+        other: End key (exclusive if forward, inclusive if reverse)
+        offset: Number of results to skip
+        limit: Maximum results to return
+
+    Returns:
+        Cursor yielding (key, value) tuples
+    """
+    shape, params = db_range_params(key, other, offset, limit)
+
+    return conn.execute(_DB_RANGE_SCAN[shape], params)
+
+
 def db_query(conn: sqlite3.Connection, key: bytes, other: bytes, offset: int = 0, limit: Optional[int] = None) -> List[Tuple[bytes, bytes]]:
     """Query key-value pairs between key and other.
 
@@ -373,25 +791,16 @@ def db_query(conn: sqlite3.Connection, key: bytes, other: bytes, offset: int = 0
     Behavior:
         - If key <= other: forward scan [key, other) in ascending order
         - If key > other: reverse scan [other, key) in descending order, starting from biggest key < key
-    """
-    if key <= other:
-        # Forward scan: key <= k < other
-        query = 'SELECT key, value FROM kv WHERE key >= ? AND key < ? ORDER BY key ASC'
-        params: List[Any] = [key, other]
-    else:
-        # Reverse scan: other <= k < key, descending order
-        query = 'SELECT key, value FROM kv WHERE key >= ? AND key < ? ORDER BY key DESC'
-        params = [other, key]
-
-    if limit is not None:
-        query += ' LIMIT ? OFFSET ?'
-        params.extend([limit, offset])
-    elif offset > 0:
-        query += ' OFFSET ?'
-        params.append(offset)
 
-    cursor = conn.execute(query, params)
-    return [(row[0], row[1]) for row in cursor]
+    Pagination:
+        SQLite still walks and discards the first `offset` rows, so offset
+        costs O(offset) per call. To page through a large range, seek from the
+        last key seen instead, with limit and no offset:
+        - forward: db_query(conn, last + b'\\x00', other, limit=n)
+        - reverse: db_query(conn, last, other, limit=n)
+    """
+    # Rows come back as (key, value) tuples already, no need to rebuild them
+    return db_query_iter(conn, key, other, offset, limit).fetchall()
 
 
 def db_bytes(conn: sqlite3.Connection, key: bytes, other: bytes, offset: int = 0, limit: Optional[int] = None) -> int:
@@ -411,25 +820,9 @@ def db_bytes(conn: sqlite3.Connection, key: bytes, other: bytes, offset: int = 0
         - If key <= other: forward scan [key, other) in ascending order
         - If key > other: reverse scan [other, key) in descending order
     """
-    if key <= other:
-        # Forward scan: key <= k < other
-        base_query = 'SELECT key, value FROM kv WHERE key >= ? AND key < ? ORDER BY key ASC'
-        params: List[Any] = [key, other]
-    else:
-        # Reverse scan: other <= k < key, descending order
-        base_query = 'SELECT key, value FROM kv WHERE key >= ? AND key < ? ORDER BY key DESC'
-        params = [other, key]
-
-    if limit is not None:
-        base_query += ' LIMIT ? OFFSET ?'
-        params.extend([limit, offset])
-    elif offset > 0:
-        base_query += ' OFFSET ?'
-        params.append(offset)
-
-    # Wrap in SUM query
-    query = f'SELECT COALESCE(SUM(LENGTH(key) + LENGTH(value)), 0) FROM ({base_query})'
-    cursor = conn.execute(query, params)
+    shape, params = db_range_params(key, other, offset, limit)
+
+    cursor = conn.execute(_DB_RANGE_BYTES[shape], params)
     return cursor.fetchone()[0]
 
 
@@ -450,25 +843,9 @@ def db_count(conn: sqlite3.Connection, key: bytes, other: bytes, offset: int = 0
         - If key <= other: forward scan [key, other) in ascending order
         - If key > other: reverse scan [other, key) in descending order
     """
-    if key <= other:
-        # Forward scan: key <= k < other
-        base_query = 'SELECT key FROM kv WHERE key >= ? AND key < ? ORDER BY key ASC'
-        params: List[Any] = [key, other]
-    else:
-        # Reverse scan: other <= k < key, descending order
-        base_query = 'SELECT key FROM kv WHERE key >= ? AND key < ? ORDER BY key DESC'
-        params = [other, key]
-
-    if limit is not None:
-        base_query += ' LIMIT ? OFFSET ?'
-        params.extend([limit, offset])
-    elif offset > 0:
-        base_query += ' OFFSET ?'
-        params.append(offset)
-
-    # Wrap in COUNT query
-    query = f'SELECT COUNT(*) FROM ({base_query})'
-    cursor = conn.execute(query, params)
+    shape, params = db_range_params(key, other, offset, limit)
+
+    cursor = conn.execute(_DB_RANGE_COUNT[shape], params)
     return cursor.fetchone()[0]
 
 
@@ -658,21 +1035,20 @@ def nstore_indices_verify_coverage(indices: List[List[int]], n: int) -> bool:
     Returns:
         True if all combinations are covered
     """
-    tab = list(range(n))
-    for r in range(1, n + 1):
-        for combination in itertools.combinations(tab, r):
-            covered = False
-            for index in indices:
-                for perm in itertools.permutations(combination):
-                    if len(perm) <= len(index):
-                        if all(a == b for a, b in zip(perm, index)):
-                            covered = True
-                            break
-                if covered:
-                    break
-            if not covered:
-                return False
-    return True
+    # A combination is covered when it is the set of the first len(combination)
+    # positions of some index. Collect those prefix sets as bitmasks, then
+    # every non-empty subset of range(n) must be among them.
+    covered = set()
+    for index in indices:
+        mask = 0
+        for position in index:
+            bit = 1 << position if 0 <= position < n else 0
+            if not bit or mask & bit:
+                # Repeated or out of range: longer prefixes cover nothing new
+                break
+            mask |= bit
+            covered.add(mask)
+    return all(mask in covered for mask in range(1, 1 << n))
 
 
 def nstore_indices(n: int) -> List[List[int]]:
@@ -699,6 +1075,22 @@ def nstore_indices(n: int) -> List[List[int]]:
         [[0, 1, 2], [1, 2, 0], [2, 0, 1]]
         >>> nstore_indices(4)  # C(4, 2) = 6 indices
         [[0, 1, 2, 3], [1, 2, 3, 0], [2, 0, 3, 1], [3, 0, 1, 2], [3, 1, 2, 0], [3, 2, 0, 1]]
+
+    The indices are computed and verified once per n; each call returns fresh
+    lists, so callers may mutate them.
+    """
+    return [list(index) for index in nstore_indices_cached(n)]
+
+
+@functools.lru_cache(maxsize=None)
+def nstore_indices_cached(n: int) -> Tuple[Tuple[int, ...], ...]:
+    """Compute and verify the indices for n once, see nstore_indices.
+
+    Args:
+        n: Number of elements in tuples
+
+    Returns:
+        Index permutations as immutable tuples, shared between callers
     """
     tab = list(range(n))
     cx = list(itertools.combinations(tab, n // 2))
@@ -730,7 +1122,7 @@ def nstore_indices(n: int) -> List[List[int]]:
     # Verify coverage
     assert nstore_indices_verify_coverage(out, n), "Generated indices do not cover all combinations"
 
-    return out
+    return tuple(tuple(index) for index in out)
 
 
 ### NSTORE TUPLE STORE ###
@@ -741,7 +1133,10 @@ Variable = namedtuple('Variable', ['name'])
 
 
 # NStore type (using namedtuple instead of class)
-NStore = namedtuple('NStore', ['prefix', 'n', 'indices'])
+# encoded_prefixes[subspace] is bytes_write(prefix + (subspace,)), computed once
+# so keys only need their variable tail encoded; combination_to_index maps each
+# tuple of concrete positions to the (index, subspace) that serves it
+NStore = namedtuple('NStore', ['prefix', 'n', 'indices', 'encoded_prefixes', 'combination_to_index'])
 
 
 def nstore_create(prefix: Tuple, n: int) -> NStore:
@@ -758,37 +1153,29 @@ def nstore_create(prefix: Tuple, n: int) -> NStore:
     return NStore(
         prefix=prefix,
         n=n,
-        indices=indices
+        indices=indices,
+        encoded_prefixes=tuple(bytes_write(prefix + (subspace,)) for subspace in range(len(indices))),
+        combination_to_index=nstore_combination_table(indices)
     )
 
 
-def nstore_permute(items: Tuple, index: List[int]) -> Tuple:
-    """Permute tuple elements according to index.
+def nstore_keys(nstore: NStore, items: Tuple) -> List[bytes]:
+    """Encode the key of a tuple in each permuted index.
 
     Args:
-        items: Tuple to permute
-        index: Permutation specification
+        nstore: NStore instance
+        items: Tuple to encode
 
     Returns:
-        Permuted tuple
-    """
-    return tuple(items[i] for i in index)
-
-
-def nstore_unpermute(items: Tuple, index: List[int]) -> Tuple:
-    """Reverse a permutation to get original tuple.
+        One key per index, in subspace order
 
-    Args:
-        items: Permuted tuple
-        index: Permutation that was applied
-
-    Returns:
-        Original tuple
+    Each item is encoded once and the encodings are joined in index order,
+    which gives the same bytes as bytes_write of the permuted tuple without
+    building it or re-encoding items for every index.
     """
-    result = [None] * len(items)
-    for i, idx in enumerate(index):
-        result[idx] = items[i]
-    return tuple(result)
+    encoded = [bytes_write_one(item) for item in items]
+    return [prefix + b''.join([encoded[i] for i in index])
+            for prefix, index in zip(nstore.encoded_prefixes, nstore.indices)]
 
 
 def nstore_add(db: sqlite3.Connection, nstore: NStore, items: Tuple) -> None:
@@ -801,11 +1188,8 @@ def nstore_add(db: sqlite3.Connection, nstore: NStore, items: Tuple) -> None:
     """
     assert len(items) == nstore.n, f"Expected {nstore.n} items, got {len(items)}"
 
-    # Add to all permuted indices
-    for subspace, index in enumerate(nstore.indices):
-        permuted = nstore_permute(items, index)
-        key = bytes_write(nstore.prefix + (subspace,) + permuted)
-        db_set(db, key, b'\x01')
+    # Add to all permuted indices in a single executemany
+    db_set_many(db, [(key, b'\x01') for key in nstore_keys(nstore, items)])
 
 
 def nstore_delete(db: sqlite3.Connection, nstore: NStore, items: Tuple) -> None:
@@ -818,11 +1202,8 @@ def nstore_delete(db: sqlite3.Connection, nstore: NStore, items: Tuple) -> None:
     """
     assert len(items) == nstore.n, f"Expected {nstore.n} items, got {len(items)}"
 
-    # Delete from all permuted indices
-    for subspace, index in enumerate(nstore.indices):
-        permuted = nstore_permute(items, index)
-        key = bytes_write(nstore.prefix + (subspace,) + permuted)
-        db_delete(db, key)
+    # Delete from all permuted indices in a single executemany
+    db_delete_many(db, nstore_keys(nstore, items))
 
 
 def nstore_ask(db: sqlite3.Connection, nstore: NStore, items: Tuple) -> bool:
@@ -839,92 +1220,28 @@ def nstore_ask(db: sqlite3.Connection, nstore: NStore, items: Tuple) -> bool:
     assert len(items) == nstore.n, f"Expected {nstore.n} items, got {len(items)}"
 
     # Check base index
-    key = bytes_write(nstore.prefix + (0,) + items)
-    return db_get(db, key) is not None
+    key = nstore.encoded_prefixes[0] + bytes_write(items)
+    return db_exists(db, key)
 
 
-def nstore_pattern_to_combination(pattern: Tuple) -> List[int]:
-    """Extract positions of non-variable elements from pattern.
+def nstore_combination_table(indices: List[List[int]]) -> Dict[Tuple[int, ...], Tuple[List[int], int]]:
+    """Map every set of concrete positions to the index and subspace serving it.
 
     Args:
-        pattern: Query pattern with Variables and concrete values
-
-    Returns:
-        List of indices where pattern has concrete values
-    """
-    return [i for i, item in enumerate(pattern) if not isinstance(item, Variable)]
-
-
-def nstore_pattern_to_index(pattern: Tuple, indices: List[List[int]]) -> Tuple[List[int], int]:
-    """Find the index and subspace that matches the pattern.
-
-    Args:
-        pattern: Query pattern
         indices: List of available indices
 
     Returns:
-        Tuple of (matching_index, subspace_number)
-    """
-    combination = nstore_pattern_to_combination(pattern)
-
-    for subspace, index in enumerate(indices):
-        # Check if any permutation of combination is a prefix of index
-        for perm in itertools.permutations(combination):
-            if len(perm) <= len(index) and all(a == b for a, b in zip(perm, index)):
-                return (index, subspace)
-
-    raise ValueError(f"No matching index found for pattern {pattern}")
-
-
-def nstore_pattern_to_prefix(pattern: Tuple, index: List[int]) -> Tuple:
-    """Extract the concrete prefix from pattern for range query.
-
-    Args:
-        pattern: Query pattern
-        index: Index permutation to use
-
-    Returns:
-        Tuple of concrete values in index order (up to first variable)
-    """
-    result = []
-    for idx in index:
-        value = pattern[idx]
-        if isinstance(value, Variable):
-            break
-        result.append(value)
-    return tuple(result)
-
-
-def nstore_bind_pattern(pattern: Tuple, bindings: Dict[str, Any]) -> Tuple:
-    """Replace variables in pattern with their bound values.
-
-    Args:
-        pattern: Query pattern with variables
-        bindings: Dictionary of variable names to values
-
-    Returns:
-        Pattern with variables substituted
-    """
-    return tuple(bindings[item.name] if isinstance(item, Variable) and item.name in bindings else item
-                 for item in pattern)
-
-
-def nstore_bind_tuple(pattern: Tuple, tuple_items: Tuple, seed: Dict[str, Any]) -> Dict[str, Any]:
-    """Bind variables in pattern to values from matching tuple.
+        Dictionary from sorted position tuples to (index, subspace_number)
 
-    Args:
-        pattern: Query pattern with variables
-        tuple_items: Concrete tuple from database
-        seed: Existing bindings to extend
-
-    Returns:
-        New bindings dictionary with variables bound
+    A set of positions is served by an index when it equals the set of one of
+    the index prefixes, so walking the prefixes of each index in subspace order
+    finds the first match without searching permutations.
     """
-    result = dict(seed)
-    for pattern_item, tuple_item in zip(pattern, tuple_items):
-        if isinstance(pattern_item, Variable):
-            result[pattern_item.name] = tuple_item
-    return result
+    table = {}
+    for subspace, index in enumerate(indices):
+        for r in range(len(index) + 1):
+            table.setdefault(tuple(sorted(index[:r])), (index, subspace))
+    return table
 
 
 def nstore_query(db: sqlite3.Connection, nstore: NStore, pattern: Tuple, *patterns: Tuple) -> List[Dict[str, Any]]:
@@ -960,50 +1277,67 @@ def nstore_query(db: sqlite3.Connection, nstore: NStore, pattern: Tuple, *patter
     """
     patterns = [pattern] + list(patterns)
 
-    # Start with initial empty binding
-    bindings = [{}]
+    # Bindings are kept as rows of values, one column per bound variable name,
+    # and only turned into dictionaries once all patterns are processed
+    names: List[str] = []
+    slots: Dict[str, int] = {}
+    rows: List[tuple] = [()]
 
     # Process each pattern
     for pat in patterns:
         assert len(pat) == nstore.n, f"Pattern length {len(pat)} doesn't match nstore size {nstore.n}"
 
-        new_bindings = []
+        # Positions that are concrete once bound, hence the index and the
+        # pattern items of its prefix, are the same for all rows
+        combination = tuple(i for i, item in enumerate(pat)
+                            if not isinstance(item, Variable) or item.name in slots)
+        index, subspace = nstore.combination_to_index[combination]
+        # Where each bound position takes its value from: (True, column) for
+        # a bound variable, (False, value) for a concrete item
+        sources = [(True, slots[item.name]) if isinstance(item, Variable) and item.name in slots else (False, item)
+                   for item in pat]
+
+        if len(combination) == nstore.n:
+            # Fully bound: a point lookup per row instead of a range scan
+            rows = [row for row in rows
+                    if nstore_ask(db, nstore, tuple(row[v] if is_column else v for is_column, v in sources))]
+            continue
 
-        for binding in bindings:
-            # Bind variables in pattern with current bindings
-            bound_pattern = nstore_bind_pattern(pat, binding)
+        prefix_sources = [sources[i] for i in index[:len(combination)]]
+        # Position in the permuted key of each new variable; when a variable
+        # repeats, the last occurrence wins
+        new_positions: Dict[str, int] = {}
+        for i, item in enumerate(pat):
+            if isinstance(item, Variable) and item.name not in slots:
+                new_positions[item.name] = index.index(i)
+        # Matching keys all start with the encoded prefix of the subspace
+        tail_start = len(nstore.encoded_prefixes[subspace])
 
-            # Find matching index
-            index, subspace = nstore_pattern_to_index(bound_pattern, nstore.indices)
+        new_rows = []
 
+        for row in rows:
             # Build prefix for range query
-            prefix_items = nstore_pattern_to_prefix(bound_pattern, index)
-            key_start = bytes_write(nstore.prefix + (subspace,) + prefix_items)
+            prefix_items = tuple(row[v] if is_column else v for is_column, v in prefix_sources)
+            key_start = nstore.encoded_prefixes[subspace] + bytes_write(prefix_items)
             key_end = bytes_next(key_start)
             if key_end is None:
                 # All bytes are 0xFF, use next longer sequence
                 key_end = key_start + b'\x00'
 
-            # Range scan
-            results = db_query(db, key_start, key_end)
-
-            for key, _ in results:
-                # Decode key
-                unpacked = bytes_read(key)
-
-                # Extract tuple (skip prefix + subspace)
-                permuted_tuple = unpacked[len(nstore.prefix) + 1:]
+            # Range scan, streamed so large matches are never held in full
+            for key, _ in db_query_iter(db, key_start, key_end):
+                # Decode the permuted tuple only, skipping prefix + subspace
+                permuted_tuple = bytes_read(key, tail_start)
 
-                # Reverse permutation
-                original_tuple = nstore_unpermute(permuted_tuple, index)
+                # Extend the row with the new variables, read in permuted order
+                new_rows.append(row + tuple(permuted_tuple[j] for j in new_positions.values()))
 
-                # Bind variables from pattern
-                new_binding = nstore_bind_tuple(pat, original_tuple, binding)
-                new_bindings.append(new_binding)
+        rows = new_rows
+        for name in new_positions:
+            slots[name] = len(names)
+            names.append(name)
 
-        bindings = new_bindings
-
-    return bindings
+    return [dict(zip(names, row)) for row in rows]
 
 
 @contextmanager
@@ -1019,12 +1353,28 @@ def db_transaction(db: sqlite3.Connection) -> Generator[sqlite3.Connection, None
     Example:
         with db_transaction(db):
             nstore_add(db, store, ('a', 'b', 'c'))
+
+    The write lock is taken up front with BEGIN IMMEDIATE, so a concurrent
+    writer makes us wait on the busy timeout at the start of the block rather
+    than failing with SQLITE_BUSY when a deferred read transaction tries to
+    upgrade.
+
+    When a transaction is already open on the connection, including the
+    implicit one sqlite3 opens for a write outside db_transaction, the block
+    joins it. Committing or rolling back is then left to whoever opened that
+    transaction, so a nested block never commits the enclosing one early, and
+    an exception rolls it back only once it reaches the outer block.
     """
+    began = not db.in_transaction
+    if began:
+        db.execute('BEGIN IMMEDIATE')
     try:
         yield db
-        db.commit()
+        if began:
+            db.commit()
     except Exception:
-        db.rollback()
+        if began:
+            db.rollback()
         raise
 
 
@@ -5115,10 +5465,9 @@ def command_aston(filepath: str, test_mode: bool = False):
             print(reconstructed_dump[:500], file=sys.stderr)
             sys.exit(1)
     else:
-        # Normal mode - output tuples as JSON lines
+        # Normal mode - output tuples as JSON lines, buffered into a single write
         _, tuples = aston_write(tree)
-        for tup in tuples:
-            print(json.dumps(tup, ensure_ascii=False))
+        sys.stdout.write(''.join(json.dumps(tup, ensure_ascii=False) + '\n' for tup in tuples))
 
 
 def main():
@@ -3,9 +3,17 @@ Tests for bytes encoding/decoding functions.
 
 Tests order-preserving encoding of Python values to bytes and back.
 """
+import enum
+import uuid
+from collections import namedtuple
+
 import pytest
 
-from bb import bytes_write, bytes_read, bytes_next
+from bb import BBH, bytes_write, bytes_write_one, bytes_write_into, bytes_read, bytes_read_one, bytes_next
+
+
+class Color(enum.IntEnum):
+    RED = 1
 
 
 # ============================================================================
@@ -48,6 +56,15 @@ def test_bytes_write_read_nested_tuple():
     assert decoded == original
 
 
+def test_bytes_write_read_deeply_nested_tuple():
+    """Test decoding tuples nested inside tuples, with None and empty tuples"""
+    original = ((1, (None, ((), 'x')), None), (((2,),),), 3)
+    encoded = bytes_write(original)
+    decoded = bytes_read(encoded)
+
+    assert decoded == original
+
+
 def test_bytes_write_read_triple():
     """Test encoding/decoding 3-tuple (common nstore case)"""
     original = ('P4X432', 'blog/title', 'hyper.dev')
@@ -116,6 +133,36 @@ def test_bytes_write_order_floats():
     assert encoded[0] < encoded[1] < encoded[2] < encoded[3]
 
 
+def test_bytes_write_order_negative_and_special_floats():
+    """Test that negative, subnormal and infinite floats sort numerically"""
+    values = [
+        (float('-inf'),), (-1e308,), (-1e9,), (-1.5,), (-1e-310,), (-5e-324,),
+        (5e-324,), (1e-310,), (1.5,), (1e9,), (1e308,), (float('inf'),),
+    ]
+
+    assert sorted(reversed(values), key=bytes_write) == values
+
+
+def test_bytes_write_read_negative_and_special_floats():
+    """Test round trip of negative, subnormal and infinite floats"""
+    for value in (-1e9, -1.5, -1e-310, -5e-324, 1e-310, float('-inf'), float('inf')):
+        assert bytes_read(bytes_write((value,))) == (value,)
+
+
+def test_bytes_write_float_encoding():
+    """Test the exact float encoding: sign bit flipped, or all bits flipped if negative"""
+    assert bytes_write((1.5,)) == b'\x07\xbf\xf8\x00\x00\x00\x00\x00\x00'
+    assert bytes_write((-1.5,)) == b'\x07\x40\x07\xff\xff\xff\xff\xff\xff'
+
+
+def test_bytes_write_zero_floats_encode_as_integer_zero():
+    """Test that 0.0 and -0.0 share the integer zero encoding"""
+    assert bytes_write((0.0,)) == bytes_write((-0.0,)) == bytes_write((0,))
+    assert bytes_read(bytes_write((-0.0,))) == (0,)
+    # Zero has the integer type code, which sorts before every float
+    assert bytes_write((0.0,)) < bytes_write((float('-inf'),))
+
+
 def test_bytes_write_order_mixed_tuples():
     """Test order preservation with mixed-type tuples"""
     values = [
@@ -147,6 +194,14 @@ def test_bytes_write_order_prefix_matching():
 # Tests for special cases
 # ============================================================================
 
+def test_bytes_read_from_position():
+    """Test decoding only the items after a known encoded prefix"""
+    prefix = bytes_write(('blog', 3))
+    encoded = prefix + bytes_write(('title', None, 1.5))
+
+    assert bytes_read(encoded, len(prefix)) == ('title', None, 1.5)
+
+
 def test_bytes_write_null_byte_in_string():
     """Test encoding string with null byte escape"""
     original = ('test\x00data',)
@@ -165,6 +220,15 @@ def test_bytes_write_null_byte_in_bytes():
     assert decoded == original
 
 
+def test_bytes_write_null_bytes_between_items():
+    """Test consecutive and trailing null bytes decode without eating the next item"""
+    original = ('a\x00\x00', b'\x00', b'\x00\xff', 'x', 1)
+    encoded = bytes_write(original)
+    decoded = bytes_read(encoded)
+
+    assert decoded == original
+
+
 def test_bytes_write_empty_string():
     """Test encoding empty string"""
     original = ('',)
@@ -183,6 +247,93 @@ def test_bytes_write_empty_bytes():
     assert decoded == original
 
 
+def test_bytes_write_read_uuid():
+    """Test UUID round trip and that encoding follows UUID byte order"""
+    low = uuid.UUID('00000000-0000-0000-0000-0000000000ff')
+    high = uuid.UUID('01000000-0000-0000-0000-000000000000')
+
+    assert bytes_write((low,)) == b'\x0a' + low.bytes
+    assert bytes_read(bytes_write((low, 'x'))) == (low, 'x')
+    assert bytes_write((low,)) < bytes_write((high,))
+
+
+def test_bytes_write_read_bbh_bytes():
+    """Test BBH given as 32 bytes decodes as the hex string"""
+    digest = bytes(range(32))
+    encoded = bytes_write((BBH(digest), 1))
+
+    assert encoded[:33] == b'\x0b' + digest
+    assert bytes_read(encoded) == (BBH(digest.hex()), 1)
+
+
+def test_bytes_write_read_bbh_hex():
+    """Test BBH given as 64 hex characters round trips"""
+    value = BBH('ab' * 32)
+
+    assert bytes_write((value,)) == bytes_write((BBH(b'\xab' * 32),))
+    assert bytes_read(bytes_write((value,))) == (value,)
+
+
+def test_bytes_write_bbh_wrong_length_bytes():
+    """Test BBH bytes that are not 32 bytes long are rejected"""
+    with pytest.raises(ValueError, match='32 bytes'):
+        bytes_write((BBH(b'\x00' * 31),))
+
+
+def test_bytes_write_bbh_wrong_length_hex():
+    """Test BBH hex strings that are not 64 characters long are rejected"""
+    with pytest.raises(ValueError, match='64 characters'):
+        bytes_write((BBH('ab' * 31),))
+
+
+def test_bytes_write_bbh_wrong_value_type():
+    """Test BBH values that are neither bytes nor str are rejected"""
+    with pytest.raises(ValueError, match='bytes or hex string'):
+        bytes_write((BBH(42),))
+
+
+def test_bytes_write_subclasses_use_base_encoding():
+    """Test that int and tuple subclasses encode like their base type"""
+    Pair = namedtuple('Pair', ['left', 'right'])
+
+    assert bytes_write((Color.RED, Pair(1, 'a'))) == bytes_write((1, (1, 'a')))
+    assert bytes_read(bytes_write((Pair(1, 'a'),))) == ((1, 'a'),)
+
+
+def test_bytes_write_into_appends_to_buffer():
+    """Test that bytes_write_into extends an existing buffer in place"""
+    out = bytearray(bytes_write(('prefix',)))
+    bytes_write_into(42, out)
+    bytes_write_into((None, 'x'), out)
+
+    assert bytes(out) == bytes_write(('prefix', 42, (None, 'x')))
+
+
+def test_bytes_read_one_roundtrip():
+    """Test that bytes_read_one decodes one value and returns the next position"""
+    data = bytes_write_one(42) + bytes_write_one(('a', None)) + bytes_write_one('tail')
+
+    value, pos = bytes_read_one(data)
+    assert value == 42
+    value, pos = bytes_read_one(data, pos)
+    assert value == ('a', None)
+    value, pos = bytes_read_one(data, pos)
+    assert value == 'tail'
+    assert pos == len(data)
+
+
+def test_bytes_read_one_unknown_code():
+    """Test decoding an unknown type code raises ValueError"""
+    with pytest.raises(ValueError):
+        bytes_read_one(b'\xfe')
+
+
+def test_bytes_write_unsupported_type():
+    """Test encoding an unsupported type raises ValueError"""
+    with pytest.raises(ValueError):
+        bytes_write((object(),))
+
+
 # ============================================================================
 # Tests for bytes_next
 # ============================================================================
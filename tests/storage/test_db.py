@@ -3,9 +3,11 @@ Tests for database functions.
 
 Tests SQLite3-based ordered key-value store operations.
 """
+import sqlite3
+
 import pytest
 
-from bb import db_open, db_get, db_set, db_delete, db_query, db_transaction, db_bytes, db_count
+from bb import db_open, db_close, db_get, db_get_many, db_exists, db_set, db_set_many, db_delete, db_delete_many, db_query, db_query_iter, db_transaction, db_bytes, db_count
 
 
 # ============================================================================
@@ -32,13 +34,117 @@ def test_db_open_file(tmp_path):
     assert db_path.exists()
 
 
-def test_db_open_creates_index():
-    """Test that db_open creates index on key column"""
+def test_db_open_enables_wal(tmp_path):
+    """Test that db_open switches file databases to WAL with synchronous=NORMAL"""
+    db = db_open(str(tmp_path / 'test.db'))
+
+    assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    # synchronous=NORMAL is reported as 1
+    assert db.execute('PRAGMA synchronous').fetchone()[0] == 1
+
+
+def test_db_open_sets_cache_pragmas():
+    """Test that db_open configures page cache and temp store"""
     db = db_open(':memory:')
 
-    # Verify index exists
-    cursor = db.execute("SELECT name FROM sqlite_master WHERE type='index' AND name='idx_key'")
-    assert cursor.fetchone() is not None
+    # Negative cache_size is expressed in KiB
+    assert db.execute('PRAGMA cache_size').fetchone()[0] == -65536
+    # temp_store=MEMORY is reported as 2
+    assert db.execute('PRAGMA temp_store').fetchone()[0] == 2
+
+
+def test_db_open_without_rowid():
+    """Test that db_open stores kv as a WITHOUT ROWID table keyed on key"""
+    db = db_open(':memory:')
+
+    cursor = db.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='kv'")
+    assert 'WITHOUT ROWID' in cursor.fetchone()[0]
+
+    # The primary key b-tree is the only index, no redundant secondary index
+    cursor = db.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='kv'")
+    assert cursor.fetchall() == []
+
+
+def test_db_open_range_scan_uses_primary_key():
+    """Test that range scans are served by the primary key b-tree"""
+    db = db_open(':memory:')
+
+    cursor = db.execute(
+        'EXPLAIN QUERY PLAN SELECT key, value FROM kv WHERE key >= ? AND key < ? ORDER BY key ASC',
+        (b'a', b'b')
+    )
+    plan = ' '.join(row[3] for row in cursor)
+    assert 'PRIMARY KEY' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def test_db_close_persists_data(tmp_path):
+    """Test that db_close closes the connection and committed data survives"""
+    db_path = str(tmp_path / 'test.db')
+    db = db_open(db_path)
+
+    with db_transaction(db):
+        db_set(db, b'key', b'value')
+    db_close(db)
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.execute('SELECT 1')
+
+    db = db_open(db_path)
+    assert db_get(db, b'key') == b'value'
+
+
+def test_db_close_twice():
+    """Test that closing an already closed connection is a no-op"""
+    db = db_open(':memory:')
+    db_close(db)
+    db_close(db)
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.execute('SELECT 1')
+
+
+class BusyOptimizeConnection(sqlite3.Connection):
+    """Connection whose PRAGMA optimize fails as if the database were locked"""
+
+    def execute(self, sql, *args):
+        if sql == 'PRAGMA optimize':
+            raise sqlite3.OperationalError('database is locked')
+        return super().execute(sql, *args)
+
+
+def test_db_close_closes_when_optimize_fails():
+    """Test that db_close still closes the connection when optimize fails"""
+    db = sqlite3.connect(':memory:', factory=BusyOptimizeConnection)
+
+    with pytest.raises(sqlite3.OperationalError, match='locked'):
+        db_close(db)
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.execute('SELECT 1')
+
+
+def test_db_open_readonly_reads_writer_commits(tmp_path):
+    """Test that a read-only connection sees committed data and cannot write"""
+    db_path = str(tmp_path / 'test.db')
+    writer = db_open(db_path)
+    reader = db_open(db_path, readonly=True)
+
+    with db_transaction(writer):
+        db_set(writer, b'key', b'value')
+    assert db_get(reader, b'key') == b'value'
+
+    with pytest.raises(sqlite3.OperationalError):
+        db_set(reader, b'other', b'value')
+
+    db_close(reader)
+    db_close(writer)
+
+
+def test_db_open_readonly_rejects_memory():
+    """Test that a read-only connection cannot be opened on ':memory:'"""
+    with pytest.raises(ValueError, match=':memory:'):
+        db_open(':memory:', readonly=True)
 
 
 # ============================================================================
@@ -129,6 +235,53 @@ def test_db_set_max_value_size():
     assert db_get(db, b'key') == max_value
 
 
+# ============================================================================
+# Tests for db_set_many
+# ============================================================================
+
+def test_db_set_many_basic():
+    """Test setting several pairs in one call"""
+    db = db_open(':memory:')
+
+    db_set_many(db, [(b'key1', b'value1'), (b'key2', b'value2'), (b'key3', b'value3')])
+
+    assert db_get(db, b'key1') == b'value1'
+    assert db_get(db, b'key2') == b'value2'
+    assert db_get(db, b'key3') == b'value3'
+
+
+def test_db_set_many_replace():
+    """Test that set_many replaces existing values"""
+    db = db_open(':memory:')
+
+    db_set(db, b'key1', b'old')
+    db_set_many(db, [(b'key1', b'new'), (b'key2', b'value2')])
+
+    assert db_get(db, b'key1') == b'new'
+    cursor = db.execute('SELECT COUNT(*) FROM kv')
+    assert cursor.fetchone()[0] == 2
+
+
+def test_db_set_many_empty():
+    """Test that set_many accepts an empty batch"""
+    db = db_open(':memory:')
+
+    db_set_many(db, [])
+
+    cursor = db.execute('SELECT COUNT(*) FROM kv')
+    assert cursor.fetchone()[0] == 0
+
+
+def test_db_set_many_size_limit_writes_nothing():
+    """Test that an oversized pair rejects the whole batch"""
+    db = db_open(':memory:')
+
+    with pytest.raises(AssertionError, match="Key size .* exceeds maximum"):
+        db_set_many(db, [(b'key1', b'value1'), (b'x' * 1025, b'value')])
+
+    assert db_get(db, b'key1') is None
+
+
 # ============================================================================
 # Tests for db_get
 # ============================================================================
@@ -166,6 +319,38 @@ def test_db_get_after_delete():
     assert result is None
 
 
+def test_db_get_many():
+    """Test getting several keys keeps order, duplicates and missing keys"""
+    db = db_open(':memory:')
+    db_set(db, b'a', b'value_a')
+    db_set(db, b'b', b'value_b')
+
+    result = db_get_many(db, [b'b', b'missing', b'a', b'b'])
+
+    assert result == [b'value_b', None, b'value_a', b'value_b']
+    assert db_get_many(db, []) == []
+
+
+def test_db_get_many_chunks_large_batches():
+    """Test getting more keys than fit in one IN (...) statement"""
+    db = db_open(':memory:')
+    keys = [i.to_bytes(2, 'big') for i in range(1200)]
+    db_set_many(db, [(key, key * 2) for key in keys[::2]])
+
+    result = db_get_many(db, keys)
+
+    assert result == [key * 2 if i % 2 == 0 else None for i, key in enumerate(keys)]
+
+
+def test_db_exists():
+    """Test checking key presence"""
+    db = db_open(':memory:')
+    db_set(db, b'key', b'')
+
+    assert db_exists(db, b'key')
+    assert not db_exists(db, b'missing')
+
+
 # ============================================================================
 # Tests for db_delete
 # ============================================================================
@@ -206,6 +391,32 @@ def test_db_delete_multiple_keys():
     assert db_get(db, b'key3') == b'value3'
 
 
+def test_db_delete_many():
+    """Test deleting several keys in one call"""
+    db = db_open(':memory:')
+
+    db_set(db, b'key1', b'value1')
+    db_set(db, b'key2', b'value2')
+    db_set(db, b'key3', b'value3')
+
+    deleted = db_delete_many(db, [b'key1', b'key3', b'missing'])
+
+    assert deleted == 2
+    assert db_get(db, b'key1') is None
+    assert db_get(db, b'key2') == b'value2'
+    assert db_get(db, b'key3') is None
+
+
+def test_db_delete_many_empty():
+    """Test that delete_many accepts an empty batch"""
+    db = db_open(':memory:')
+
+    db_set(db, b'key1', b'value1')
+
+    assert db_delete_many(db, []) == 0
+    assert db_get(db, b'key1') == b'value1'
+
+
 # ============================================================================
 # Tests for db_query
 # ============================================================================
@@ -311,6 +522,81 @@ def test_db_query_offset_and_limit():
     assert results[1] == (b'c', b'value_c')
 
 
+def test_db_query_offset_without_limit():
+    """Test query with offset and no limit"""
+    db = db_open(':memory:')
+
+    db_set(db, b'a', b'value_a')
+    db_set(db, b'b', b'value_b')
+    db_set(db, b'c', b'value_c')
+    db_set(db, b'd', b'value_d')
+
+    results = db_query(db, b'a', b'e', offset=2)
+
+    assert results == [(b'c', b'value_c'), (b'd', b'value_d')]
+
+
+def test_db_query_reverse_offset_and_limit():
+    """Test reverse query with both offset and limit"""
+    db = db_open(':memory:')
+
+    db_set(db, b'a', b'value_a')
+    db_set(db, b'b', b'value_b')
+    db_set(db, b'c', b'value_c')
+    db_set(db, b'd', b'value_d')
+
+    # Reverse [e, a): d, c, b, a -> skip d, take c and b
+    results = db_query(db, b'e', b'a', offset=1, limit=2)
+
+    assert results == [(b'c', b'value_c'), (b'b', b'value_b')]
+
+
+def test_db_query_keyset_pagination():
+    """Test paging through a range by seeking from the last key seen"""
+    db = db_open(':memory:')
+
+    keys = [b'a', b'b', b'b\x00', b'c', b'd']
+    for key in keys:
+        db_set(db, key, b'value')
+
+    # Forward: restart just after the last key of the previous page
+    pages = []
+    start = b'a'
+    while True:
+        page = db_query(db, start, b'e', limit=2)
+        if not page:
+            break
+        pages.append([k for k, _ in page])
+        start = page[-1][0] + b'\x00'
+    assert pages == [[b'a', b'b'], [b'b\x00', b'c'], [b'd']]
+
+    # Reverse: the last key seen becomes the exclusive upper bound
+    pages = []
+    start = b'e'
+    while True:
+        page = db_query(db, start, b'a', limit=2)
+        if not page:
+            break
+        pages.append([k for k, _ in page])
+        start = page[-1][0]
+    assert pages == [[b'd', b'c'], [b'b\x00', b'b'], [b'a']]
+
+
+def test_db_query_iter_matches_db_query():
+    """Test that db_query_iter streams the same rows as db_query"""
+    db = db_open(':memory:')
+
+    db_set(db, b'a', b'value_a')
+    db_set(db, b'b', b'value_b')
+    db_set(db, b'c', b'value_c')
+
+    rows = db_query_iter(db, b'a', b'z')
+    assert next(rows) == (b'a', b'value_a')
+    assert list(rows) == [(b'b', b'value_b'), (b'c', b'value_c')]
+
+    assert list(db_query_iter(db, b'z', b'a', offset=1, limit=1)) == db_query(db, b'z', b'a', offset=1, limit=1)
+
+
 def test_db_query_prefix_scan():
     """Test prefix scan using range query"""
     db = db_open(':memory:')
@@ -388,6 +674,51 @@ def test_db_transaction_nested_operations():
     assert db_get(db, b'key2') == b'value2'
 
 
+def test_db_transaction_takes_write_lock_immediately(tmp_path):
+    """Test that db_transaction holds the write lock before the first write"""
+    db_path = str(tmp_path / 'test.db')
+    db = db_open(db_path)
+    other = db_open(db_path)
+    other.execute('PRAGMA busy_timeout=0')
+
+    with db_transaction(db):
+        assert db.in_transaction
+        # No write issued yet, but another writer is already locked out
+        with pytest.raises(sqlite3.OperationalError, match="locked"):
+            other.execute('BEGIN IMMEDIATE')
+
+    # Lock released after commit
+    other.execute('BEGIN IMMEDIATE')
+    other.rollback()
+
+
+def test_db_transaction_inner_block_joins_outer():
+    """Test that a nested block neither commits nor rolls back the outer one"""
+    db = db_open(':memory:')
+
+    with pytest.raises(ValueError):
+        with db_transaction(db):
+            db_set(db, b'a', b'1')
+            with db_transaction(db):
+                db_set(db, b'b', b'2')
+            assert db.in_transaction
+            raise ValueError("Test error")
+
+    assert db_get(db, b'a') is None
+    assert db_get(db, b'b') is None
+
+    with db_transaction(db):
+        with pytest.raises(ValueError):
+            with db_transaction(db):
+                db_set(db, b'c', b'3')
+                raise ValueError("Test error")
+        db_set(db, b'd', b'4')
+
+    # The outer block decided: the inner failure did not roll back its write
+    assert db_get(db, b'c') == b'3'
+    assert db_get(db, b'd') == b'4'
+
+
 def test_db_transaction_returns_db():
     """Test that transaction yields database connection"""
     db = db_open(':memory:')
@@ -616,6 +947,30 @@ def test_db_count_with_offset_and_limit():
     assert count == 2
 
 
+def test_db_bytes_and_count_offset_without_limit():
+    """Test bytes and count with offset and no limit"""
+    db = db_open(':memory:')
+
+    db_set(db, b'a', b'11')   # key: 1, value: 2 = 3
+    db_set(db, b'b', b'222')  # key: 1, value: 3 = 4
+    db_set(db, b'c', b'3333') # key: 1, value: 4 = 5
+
+    assert db_bytes(db, b'a', b'd', offset=1) == 9
+    assert db_count(db, b'a', b'd', offset=1) == 2
+
+
+def test_db_count_reverse_with_offset_and_limit():
+    """Test that reverse count with offset and limit matches forward count"""
+    db = db_open(':memory:')
+
+    for key in (b'a', b'b', b'c', b'd', b'e'):
+        db_set(db, key, b'value')
+
+    assert db_count(db, b'f', b'a', offset=1, limit=3) == 3
+    assert db_count(db, b'f', b'a', offset=3, limit=3) == 2
+    assert db_count(db, b'f', b'a', offset=3, limit=3) == db_count(db, b'a', b'f', offset=3, limit=3)
+
+
 def test_db_count_single_key():
     """Test count with single matching key"""
     db = db_open(':memory:')
@@ -625,3 +980,23 @@ def test_db_count_single_key():
     count = db_count(db, b'key', b'key\x00')
 
     assert count == 1
+
+
+def test_db_bytes_and_count_plans_never_materialize():
+    """Test that every db_bytes/db_count shape scans the primary key without temp storage"""
+    db = db_open(':memory:')
+    statements = []
+    db.set_trace_callback(statements.append)
+
+    for key, other in ((b'a', b'z'), (b'z', b'a')):
+        for offset, limit in ((0, None), (1, None), (0, 2), (1, 2)):
+            db_bytes(db, key, other, offset=offset, limit=limit)
+            db_count(db, key, other, offset=offset, limit=limit)
+    db.set_trace_callback(None)
+
+    assert len(statements) == 16
+    for sql in statements:
+        plan = ' '.join(row[3] for row in db.execute('EXPLAIN QUERY PLAN ' + sql))
+        assert 'USING PRIMARY KEY' in plan
+        assert 'MATERIALIZE' not in plan
+        assert 'TEMP B-TREE' not in plan
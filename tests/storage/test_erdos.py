@@ -15,7 +15,7 @@ coefficient C(n, n//2), which is the number of ways to choose n//2 items from n.
 import pytest
 import math
 
-from bb import nstore_indices
+from bb import nstore_indices, nstore_indices_verify_coverage
 
 
 def test_nstore_indices_central_binomial_coefficient():
@@ -148,3 +148,21 @@ def test_nstore_indices_n5_specific_first_index():
 
     # First index should be [0, 1, 2, 3, 4]
     assert indices[0] == [0, 1, 2, 3, 4]
+
+
+def test_nstore_indices_returns_fresh_lists():
+    """Test that mutating a result does not leak into later calls"""
+    indices = nstore_indices(3)
+    indices[0].append(99)
+    indices.pop()
+
+    assert nstore_indices(3) == [[0, 1, 2], [1, 2, 0], [2, 0, 1]]
+
+
+def test_nstore_indices_verify_coverage_detects_gaps():
+    """Test that coverage verification rejects index sets missing a combination"""
+    assert nstore_indices_verify_coverage([[0, 1, 2], [1, 2, 0], [2, 0, 1]], 3)
+    # (0, 2) is the prefix of no index
+    assert not nstore_indices_verify_coverage([[0, 1, 2], [1, 2, 0], [2, 1, 0]], 3)
+    # A repeated position does not make a prefix cover more positions
+    assert not nstore_indices_verify_coverage([[0, 0, 1], [1, 2, 0], [2, 0, 1]], 3)
@@ -6,11 +6,13 @@ Tests NStore operations: add, ask, delete, and query with pattern matching.
 import pytest
 
 from bb import (
+    bytes_write,
     db_open,
     nstore_create,
     nstore_add,
     nstore_ask,
     nstore_delete,
+    nstore_keys,
     nstore_query,
     Variable
 )
@@ -49,6 +51,38 @@ def test_nstore_create_generates_indices():
         assert len(index) == 4
 
 
+def test_nstore_create_encoded_prefixes():
+    """Test that nstore_create pre-encodes the prefix of every subspace"""
+    store = nstore_create(('blog',), 3)
+
+    assert len(store.encoded_prefixes) == len(store.indices)
+    for subspace, encoded in enumerate(store.encoded_prefixes):
+        assert encoded == bytes_write(('blog', subspace))
+
+
+def test_nstore_create_combination_to_index():
+    """Test that every combination of concrete positions maps to a covering index"""
+    store = nstore_create((0,), 4)
+
+    assert len(store.combination_to_index) == 2 ** 4
+    for combination, (index, subspace) in store.combination_to_index.items():
+        assert store.indices[subspace] == index
+        assert sorted(index[:len(combination)]) == list(combination)
+
+
+def test_nstore_keys_match_permuted_encoding():
+    """Test that nstore_keys encodes the tuple once per index, permuted"""
+    store = nstore_create(('blog',), 4)
+    items = ('P4X432', 'post/title', None, 42)
+
+    keys = nstore_keys(store, items)
+
+    assert keys == [
+        bytes_write(('blog', subspace) + tuple(items[i] for i in index))
+        for subspace, index in enumerate(store.indices)
+    ]
+
+
 # ============================================================================
 # Tests for nstore_add
 # ============================================================================
@@ -271,6 +305,25 @@ def test_nstore_query_no_variables():
     assert results[0] == {}  # No variables, empty binding
 
 
+def test_nstore_query_fully_bound_join_pattern():
+    """Test a join pattern whose variables are all bound acts as a filter"""
+    db = db_open(':memory:')
+    store = nstore_create((0,), 3)
+
+    nstore_add(db, store, ('user123', 'name', 'Alice'))
+    nstore_add(db, store, ('user456', 'name', 'Bob'))
+    nstore_add(db, store, ('user123', 'admin', True))
+
+    results = nstore_query(
+        db, store,
+        (Variable('uid'), 'name', Variable('name')),
+        (Variable('uid'), 'admin', True)
+    )
+
+    assert results == [{'uid': 'user123', 'name': 'Alice'}]
+    assert nstore_query(db, store, ('user456', 'admin', True)) == []
+
+
 # ============================================================================
 # Tests for nstore_query - Multi-pattern joins
 # ============================================================================